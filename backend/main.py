@@ -1,17 +1,34 @@
 from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect, status, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Dict, Any, Optional, Union, Literal
+from typing import List, Dict, Any, Optional, Union, Literal, Tuple, FrozenSet
 import agents
 from agents import Agent, Runner, function_tool, RunContextWrapper, set_default_openai_client, set_tracing_disabled
+from agents import AgentUpdatedStreamEvent, RawResponsesStreamEvent, RunItemStreamEvent
+from agents import FileSearchTool, WebSearchTool
 from agents.result import RunResultStreaming
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient, RateLimitError
 import os
 import json
+import random
+import hashlib
+import hmac
 import asyncio
-import uuid
+from collections import deque
+from secrets import token_hex
+import time
+from functools import lru_cache, singledispatch
 from datetime import datetime
 import logging
+import httpx
+import orjson
+import cloudpickle
+from cachetools import LRUCache, TTLCache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from starlette.websockets import WebSocketState
 
@@ -22,11 +39,48 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Disable tracing to prevent errors when using Azure OpenAI
+    set_tracing_disabled(disabled=True)
+    logger.info("OpenAI Agents SDK tracing disabled.")
+
+    # Read access control settings once
+    load_api_key_settings()
+
+    # Function tool code is compiled in worker processes, off the event loop
+    app.state.tool_exec_pool = ProcessPoolExecutor(max_workers=TOOL_POOL_WORKERS)
+
+    # Configure Azure OpenAI once and share the client across requests
+    app.state.azure_client = setup_azure_openai()
+    app.state.batch_queue = None
+    if app.state.azure_client is None:
+        logger.warning("Failed to configure Azure OpenAI client on startup")
+    else:
+        app.state.batch_queue = BatchQueue(app.state.azure_client)
+        app.state.batch_queue.start()
+
+    # Enable verbose logging if specified
+    if os.getenv("ENABLE_VERBOSE_LOGGING", "false").lower() == "true":
+        agents.enable_verbose_stdout_logging()
+        logger.info("Verbose logging enabled")
+
+    yield
+
+    if app.state.batch_queue is not None:
+        await app.state.batch_queue.stop()
+    app.state.tool_exec_pool.shutdown(wait=False, cancel_futures=True)
+    if app.state.azure_client is not None:
+        # Also closes the underlying httpx client
+        await app.state.azure_client.close()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="AI Agent Workbench API",
     description="API for creating, configuring, and running AI agents",
     version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # Add CORS middleware
@@ -42,10 +96,51 @@ app.add_middleware(
 API_KEY_HEADER = APIKeyHeader(name="X-API-Key", auto_error=False)
 
 # In-memory storage (replace with database in production)
-agent_configs = {}
-agent_instances = {}
-conversations = {}
-traces = {}
+# Agent configurations persist; everything else is bounded so a long-running
+# server does not grow without limit.
+agent_configs: Dict[str, "AgentConfig"] = {}
+compiled_tools: Dict[str, List[Any]] = {}
+agent_instances: LRUCache = LRUCache(maxsize=256)
+conversations: TTLCache = TTLCache(maxsize=50_000, ttl=7 * 86400)
+# Traces are immutable once written, so they are stored as serialized JSON
+traces: TTLCache = TTLCache(maxsize=10_000, ttl=86400)
+# Status of runs submitted to the Azure Batch API, keyed by run ID. Kept well
+# beyond the 24h completion window so late batches can still be collected.
+BATCH_RUN_TTL = 3 * 86400
+batch_runs: TTLCache = TTLCache(maxsize=10_000, ttl=BATCH_RUN_TTL)
+
+# Messages kept per conversation; older ones are dropped as new ones arrive
+MAX_HISTORY = int(os.getenv("MAX_HISTORY", "200"))
+
+# Interval at which queued stream events are flushed to the WebSocket client
+STREAM_BATCH_INTERVAL = 0.01
+# Events buffered per stream before the agent run waits for the client to catch up
+STREAM_QUEUE_SIZE = 256
+# Marks the end of a stream in the event queue
+_STREAM_END = object()
+
+# How long a health check result is reused before Azure is queried again
+HEALTH_CACHE_TTL = 60.0
+# (monotonic timestamp, status) of the last Azure deployments probe
+_deployments_cache: Optional[Tuple[float, "AzureOpenAIStatus"]] = None
+_deployments_lock = asyncio.Lock()
+
+# Batch-mode runs are submitted to the Azure Batch API once this many are
+# pending or this many seconds after the first one was queued
+BATCH_MAX_PENDING = 100
+BATCH_FLUSH_INTERVAL = 0.2
+# Azure batch job states after which a batch run no longer needs polling
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# One lock per Azure batch so concurrent polls collect its output only once
+_batch_locks: TTLCache = TTLCache(maxsize=10_000, ttl=BATCH_RUN_TTL)
+
+# Maximum concurrent agent runs per bulk request, and retries on rate limiting
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "10"))
+BULK_MAX_RETRIES = 5
+
+# Worker processes for compiling function tool code, and how long one tool may take
+TOOL_POOL_WORKERS = 2
+TOOL_COMPILE_TIMEOUT = 10.0
 
 # Azure OpenAI model mapping
 AZURE_MODEL_MAPPING = {
@@ -54,6 +149,9 @@ AZURE_MODEL_MAPPING = {
     # "gpt-3.5-turbo": os.getenv("AZURE_GPT35_TURBO_DEPLOYMENT"),
 }
 
+# Azure Batch only accepts Global-Batch or Data-Zone-Batch deployments
+AZURE_BATCH_DEPLOYMENT = os.getenv("AZURE_OPENAI_BATCH_DEPLOYMENT_NAME")
+
 # ------------------ Models ------------------
 
 class ToolConfig(BaseModel):
@@ -64,7 +162,7 @@ class ToolConfig(BaseModel):
     parameters: Optional[Dict[str, Any]] = None
 
 class AgentConfig(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: token_hex(16))
     name: str
     instructions: str
     model: str = "gpt-4.1"
@@ -76,6 +174,17 @@ class RunRequest(BaseModel):
     agent_id: str
     input: str
     conversation_id: Optional[str] = None
+    batch: bool = False
+    
+class BulkRunRequest(BaseModel):
+    agent_id: str
+    inputs: List[str]
+    
+class BulkRunResult(BaseModel):
+    input: str
+    final_output: Optional[str] = None
+    status: str = "completed"
+    error: Optional[str] = None
     
 class MessageItem(BaseModel):
     role: str
@@ -98,19 +207,45 @@ class AzureOpenAIStatus(BaseModel):
     
 # ------------------ Dependency Functions ------------------
 
+@lru_cache(maxsize=None)
+def load_api_key_settings() -> Tuple[bool, FrozenSet[bytes]]:
+    """Read ENABLE_PUBLIC_ACCESS and the SHA-256 digests of the comma-separated API_KEYS."""
+    public_access = os.getenv("ENABLE_PUBLIC_ACCESS", "false").lower() == "true"
+    api_key_hashes = frozenset(
+        hashlib.sha256(key.strip().encode()).digest()
+        for key in os.getenv("API_KEYS", "").split(",")
+        if key.strip()
+    )
+    return public_access, api_key_hashes
+
 async def get_api_key(api_key: str = Depends(API_KEY_HEADER)):
-    if not api_key and not os.getenv("ENABLE_PUBLIC_ACCESS", "false").lower() == "true":
+    public_access, api_key_hashes = load_api_key_settings()
+    if public_access:
+        return api_key
+    if not api_key:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="API key is required",
         )
+    # Without configured keys any key is accepted; otherwise compare digests in constant time
+    if api_key_hashes:
+        digest = hashlib.sha256(api_key.encode()).digest()
+        valid = False
+        for key_hash in api_key_hashes:
+            valid |= hmac.compare_digest(digest, key_hash)
+        if not valid:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid API key",
+            )
     return api_key
 
-async def setup_azure_openai():
-    """Configure the Azure OpenAI client for the agents SDK."""
+def setup_azure_openai() -> Optional[AsyncAzureOpenAI]:
+    """Create the shared Azure OpenAI client and register it with the agents SDK.
+
+    Returns the client, or None if it could not be configured.
+    """
     try:
-        from openai import AsyncAzureOpenAI
-        
         # Check if Azure OpenAI credentials are configured
         azure_api_key = os.getenv("AZURE_OPENAI_API_KEY")
         azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -119,11 +254,19 @@ async def setup_azure_openai():
         if not azure_api_key or not azure_endpoint:
             raise ValueError("Azure OpenAI credentials not properly configured")
         
+        # Long-lived HTTP/2 connection pool so concurrent runs share keep-alive connections
+        http_client = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        )
+        
         # Create Azure OpenAI client
         azure_client = AsyncAzureOpenAI(
             azure_endpoint=azure_endpoint,
             api_key=azure_api_key,
-            api_version=azure_api_version
+            api_version=azure_api_version,
+            http_client=http_client
         )
         
         # Set the client as the default client for the agents SDK
@@ -133,10 +276,10 @@ async def setup_azure_openai():
         agents.set_default_openai_api("chat_completions")
         
         logger.info("Azure OpenAI client configured successfully")
-        return True
+        return azure_client
     except Exception as e:
         logger.error(f"Failed to configure Azure OpenAI client: {str(e)}")
-        return False
+        return None
 
 # ------------------ API Endpoints ------------------
 
@@ -146,79 +289,72 @@ async def root():
 
 @app.get("/api/health", response_model=AzureOpenAIStatus)
 async def health_check():
-    # Test Azure OpenAI connection
-    try:
-        from openai import AsyncAzureOpenAI
-        
-        azure_api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        
-        if not azure_api_key or not azure_endpoint:
-            return AzureOpenAIStatus(status="error", models=["Azure OpenAI credentials not configured"])
-            
-        client = AsyncAzureOpenAI(
-            azure_endpoint=azure_endpoint,
-            api_key=azure_api_key,
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2025-03-01-preview")
-        )
-        
-        # Get deployments
-        deployments = await client.deployments.list()
-        available_models = [d.id for d in deployments.data]
-        
-        return AzureOpenAIStatus(
-            status="ok",
-            models=available_models
-        )
-    except Exception as e:
-        logger.error(f"Azure OpenAI health check failed: {str(e)}")
-        return AzureOpenAIStatus(
-            status="error",
-            models=[f"Error: {str(e)}"]
-        )
+    global _deployments_cache
+    
+    client = app.state.azure_client
+    if client is None:
+        return AzureOpenAIStatus(status="error", models=["Azure OpenAI credentials not configured"])
+    
+    # Reuse a recent probe; concurrent checks share a single upstream call
+    cached = _deployments_cache
+    if cached is not None and time.monotonic() - cached[0] < HEALTH_CACHE_TTL:
+        return cached[1]
+    async with _deployments_lock:
+        cached = _deployments_cache
+        if cached is not None and time.monotonic() - cached[0] < HEALTH_CACHE_TTL:
+            return cached[1]
+        azure_status = await fetch_azure_status(client)
+        _deployments_cache = (time.monotonic(), azure_status)
+        return azure_status
 
 # Agent Configuration Endpoints
 
 @app.post("/api/agents", response_model=AgentConfig)    
 async def create_agent(agent_config: AgentConfig, _: str = Depends(get_api_key)):
-    agent_configs[agent_config.id] = agent_config.model_dump()
+    compiled_tools[agent_config.id] = await build_tools(agent_config)
+    agent_configs[agent_config.id] = agent_config
+    
+    # Warm the instance cache so the first run does not pay for building the agent
+    agent_instances[agent_config.id] = _build_agent(agent_config)
     return agent_config
 
 @app.get("/api/agents", response_model=List[AgentConfig])
 async def list_agents(_: str = Depends(get_api_key)):
-    return [AgentConfig(**config) for config in agent_configs.values()]
+    # Stored configs are already validated, so skip response model validation
+    return ORJSONResponse(
+        content=[config.model_dump(mode="json", exclude_none=True) for config in agent_configs.values()]
+    )
 
-@app.get("/api/agents/{agent_id}", response_model=AgentConfig)
+@app.get("/api/agents/{agent_id}", response_model=AgentConfig, response_model_exclude_none=True)
 async def get_agent(agent_id: str, _: str = Depends(get_api_key)):
-    if agent_id not in agent_configs:
-        raise HTTPException(status_code=404, detail="Agent not found")
-    return AgentConfig(**agent_configs[agent_id])
+    return _get_or_404(agent_configs, agent_id, "Agent")
 
 @app.put("/api/agents/{agent_id}", response_model=AgentConfig)
 async def update_agent(agent_id: str, agent_config: AgentConfig, _: str = Depends(get_api_key)):
-    if agent_id not in agent_configs:
-        raise HTTPException(status_code=404, detail="Agent not found")
+    _get_or_404(agent_configs, agent_id, "Agent")
     
-    agent_config.id = agent_id
-    agent_config.updated_at = datetime.now()
-    agent_configs[agent_id] = agent_config.model_dump()
+    agent_config = agent_config.model_copy(update={"id": agent_id, "updated_at": datetime.now()})
+    tools = await build_tools(agent_config)
     
-    # Clear cached agent instance if it exists
-    if agent_id in agent_instances:
-        del agent_instances[agent_id]
+    # The agent may have been deleted while its tools were compiling
+    _get_or_404(agent_configs, agent_id, "Agent")
+    compiled_tools[agent_id] = tools
+    agent_configs[agent_id] = agent_config
+    
+    # Replace the cached agent instance with one built from the new configuration
+    agent_instances[agent_id] = _build_agent(agent_config)
         
     return agent_config
 
 @app.delete("/api/agents/{agent_id}")
 async def delete_agent(agent_id: str, _: str = Depends(get_api_key)):
-    if agent_id not in agent_configs:
-        raise HTTPException(status_code=404, detail="Agent not found")
+    _get_or_404(agent_configs, agent_id, "Agent")
     
     del agent_configs[agent_id]
+    compiled_tools.pop(agent_id, None)
     
     # Clear cached agent instance if it exists
-    if agent_id in agent_instances:
-        del agent_instances[agent_id]
+    agent_instances.pop(agent_id, None)
         
     return {"message": "Agent deleted"}
 
@@ -226,25 +362,41 @@ async def delete_agent(agent_id: str, _: str = Depends(get_api_key)):
 
 @app.post("/api/run", response_model=RunResponse)
 async def run_agent(run_request: RunRequest, background_tasks: BackgroundTasks, api_key: str = Depends(get_api_key)):
-    # Ensure Azure OpenAI is configured
-    await setup_azure_openai()
-    
-    if run_request.agent_id not in agent_configs:
-        raise HTTPException(status_code=404, detail="Agent not found")
+    config = _get_or_404(agent_configs, run_request.agent_id, "Agent")
+    if run_request.batch and app.state.batch_queue is None:
+        raise HTTPException(status_code=503, detail="Azure OpenAI client not configured")
+    if run_request.batch and not AZURE_BATCH_DEPLOYMENT:
+        raise HTTPException(status_code=503, detail="Azure OpenAI batch deployment not configured")
     
     # Generate run ID and conversation ID if not provided
-    run_id = str(uuid.uuid4())
-    conversation_id = run_request.conversation_id or str(uuid.uuid4())
-    
-    # Initialize conversation if it doesn't exist
-    if conversation_id not in conversations:
-        conversations[conversation_id] = []
+    run_id = token_hex(16)
+    conversation_id = run_request.conversation_id or token_hex(16)
     
     # Add user message to conversation
-    conversations[conversation_id].append({
-        "role": "user",
-        "content": run_request.input
-    })
+    _append_message(conversation_id, MessageItem(role="user", content=run_request.input))
+    
+    # Non-interactive runs go to the Azure Batch API and are polled via /api/run/{run_id}
+    if run_request.batch:
+        batch_runs[run_id] = {
+            "batch_id": None,
+            "status": "queued",
+            "agent_id": run_request.agent_id,
+            "conversation_id": conversation_id,
+            "final_output": None,
+        }
+        app.state.batch_queue.submit(run_id, {
+            "model": AZURE_BATCH_DEPLOYMENT,
+            "messages": [
+                {"role": "system", "content": config.instructions},
+                {"role": "user", "content": run_request.input},
+            ],
+        })
+        return RunResponse(
+            run_id=run_id,
+            agent_id=run_request.agent_id,
+            conversation_id=conversation_id,
+            status="queued"
+        )
     
     # Run the agent in a background task to allow for returning immediately
     background_tasks.add_task(
@@ -262,6 +414,61 @@ async def run_agent(run_request: RunRequest, background_tasks: BackgroundTasks,
         status="running"
     )
 
+@app.post("/api/run/bulk", response_model=List[BulkRunResult])
+async def run_agent_bulk(bulk_request: BulkRunRequest, _: str = Depends(get_api_key)):
+    agent = await get_agent_instance(bulk_request.agent_id)
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    
+    async def run_one(input_text: str):
+        async with semaphore:
+            return await run_with_backoff(agent, input_text)
+    
+    # Run all inputs concurrently, at most BULK_CONCURRENCY at a time
+    results = await asyncio.gather(
+        *(run_one(input_text) for input_text in bulk_request.inputs),
+        return_exceptions=True
+    )
+    
+    bulk_results = []
+    for input_text, result in zip(bulk_request.inputs, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Error running agent: {str(result)}")
+            bulk_results.append(BulkRunResult(input=input_text, status="failed", error=str(result)))
+        else:
+            bulk_results.append(BulkRunResult(input=input_text, final_output=result.final_output))
+    return bulk_results
+
+@app.get("/api/run/{run_id}", response_model=RunResponse)
+async def get_batch_run(run_id: str, _: str = Depends(get_api_key)):
+    batch_run = _get_or_404(batch_runs, run_id, "Batch run")
+    
+    # Refresh from Azure until the batch reaches a final state
+    batch_id = batch_run["batch_id"]
+    if batch_id is not None and batch_run["status"] not in BATCH_TERMINAL_STATUSES:
+        lock = _batch_locks.setdefault(batch_id, asyncio.Lock())
+        async with lock:
+            # Another poll may have collected this batch while we were waiting
+            if batch_run["status"] not in BATCH_TERMINAL_STATUSES:
+                client = app.state.azure_client
+                batch = await client.batches.retrieve(batch_id)
+                if batch.status == "completed":
+                    await collect_batch_output(client, batch)
+                elif batch.status in BATCH_TERMINAL_STATUSES:
+                    _finish_batch_runs(batch_id, batch.status)
+                else:
+                    batch_run["status"] = batch.status
+                # Every run of a finished batch is now terminal, so its files are no longer needed
+                if batch.status in BATCH_TERMINAL_STATUSES:
+                    await delete_batch_files(client, batch.input_file_id, batch.output_file_id, batch.error_file_id)
+    
+    return RunResponse(
+        run_id=run_id,
+        agent_id=batch_run["agent_id"],
+        conversation_id=batch_run["conversation_id"],
+        final_output=batch_run["final_output"],
+        status=batch_run["status"]
+    )
+
 async def run_agent_task(run_id: str, agent_id: str, conversation_id: str, input_text: str):
     try:
         # Get or create agent instance
@@ -271,26 +478,20 @@ async def run_agent_task(run_id: str, agent_id: str, conversation_id: str, input
         result = await Runner.run(agent, input_text)
         
         # Add assistant message to conversation
-        conversations[conversation_id].append({
-            "role": "assistant",
-            "content": result.final_output
-        })
+        _append_message(conversation_id, MessageItem(role="assistant", content=result.final_output))
         
         # Store trace information
-        traces[run_id] = {
-            "raw_responses": [r.model_dump() for r in result.raw_responses],
-            "new_items": [item.model_dump() for item in result.new_items],
+        traces[run_id] = dump_trace({
+            "raw_responses": result.raw_responses,
+            "new_items": [{"type": item.type, "raw_item": item.raw_item} for item in result.new_items],
             "timestamp": datetime.now().isoformat()
-        }
+        })
         
         logger.info(f"Agent run completed: {run_id}")
     except Exception as e:
         logger.error(f"Error running agent: {str(e)}")
         # Add error message to conversation
-        conversations[conversation_id].append({
-            "role": "system",
-            "content": f"Error: {str(e)}"
-        })
+        _append_message(conversation_id, MessageItem(role="system", content=f"Error: {str(e)}"))
 
 @app.websocket("/api/stream/{agent_id}")
 async def stream_agent_run(websocket: WebSocket, agent_id: str):
@@ -298,90 +499,76 @@ async def stream_agent_run(websocket: WebSocket, agent_id: str):
     await websocket.accept()
     logger.info(f"WebSocket connection accepted for agent_id: {agent_id}")
     
+    event_queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    sender = None
     try:
         # Get message data
         data = await websocket.receive_text()
         run_data = json.loads(data)
         
         input_text = run_data.get("input")
-        conversation_id = run_data.get("conversation_id", str(uuid.uuid4()))
-        
-        # Ensure Azure OpenAI is configured
-        await setup_azure_openai()
+        conversation_id = run_data.get("conversation_id") or token_hex(16)
         
         # Get or create agent instance
         agent = await get_agent_instance(agent_id)
         
-        # Initialize conversation if it doesn't exist
-        if conversation_id not in conversations:
-            conversations[conversation_id] = []
-        
         # Add user message to conversation
-        conversations[conversation_id].append({
-            "role": "user",
-            "content": input_text
-        })
+        _append_message(conversation_id, MessageItem(role="user", content=input_text))
         
         # Run the agent with streaming
         result = Runner.run_streamed(agent, input_text)
         
-        # Stream events to the client
+        # Stream events to the client in batches, keeping them for the trace as we go.
+        # Events go through a bounded queue so a slow client only stalls the run once it is full.
+        sender = asyncio.create_task(drain_stream_events(websocket, event_queue))
+        trace_items: List[Dict[str, Any]] = []
+        enqueue = event_queue.put
         async for event in result.stream_events():
-            event_type_str = "unknown_event"
-            # Try to get event type safely
-            if hasattr(event, 'type') and isinstance(event.type, str):
-                event_type_str = event.type
-            elif hasattr(event, '__class__') and hasattr(event.__class__, '__name__'):
-                event_type_str = event.__class__.__name__ # Fallback to class name
-
-            data_to_send = None
-            if hasattr(event, 'data') and event.data is not None:
-                if hasattr(event.data, 'model_dump'):
-                    data_to_send = event.data.model_dump()
-                else:
-                    data_to_send = event.data # Send as is if not a Pydantic model
-            elif hasattr(event, 'model_dump'): # If the event itself is a Pydantic model
-                data_to_send = event.model_dump()
-            else:
-                # Fallback for events that don't fit the above structures
-                logger.warning(f"Event of type {event_type_str} does not have a standard .data or .model_dump() method. Raw event: {str(event)}")
-                # For AgentUpdatedStreamEvent, this part might need specific handling
-                # if its relevant payload is in other attributes.
-                # Sending a generic structure for now.
-                data_to_send = {"message": f"Unstructured event: {event_type_str}", "content": str(event) }
-
-            await websocket.send_json({
+            if sender.done():
+                # Surface send failures (e.g. a disconnected client) instead of blocking on a full queue
+                await sender
+            event_type_str, data_to_send = serialize_stream_event(event)
+            await enqueue({
                 "type": event_type_str,
                 "data": data_to_send
             })
+            trace_items.append({
+                "type": event_type_str,
+                "data": data_to_send,
+                "timestamp": datetime.now().isoformat()
+            })
         
-        # Send final output
-        await websocket.send_json({
+        # Send final output and wait for the last batch to be flushed
+        await enqueue({
             "type": "final_output",
             "data": {"content": result.final_output}
         })
+        await enqueue(_STREAM_END)
+        await sender
         
         # Add assistant message to conversation
-        conversations[conversation_id].append({
-            "role": "assistant",
-            "content": result.final_output
-        })
+        _append_message(conversation_id, MessageItem(role="assistant", content=result.final_output))
         
         # Store trace information
-        run_id = str(uuid.uuid4())
-        traces[run_id] = {
-            "raw_responses": [r.model_dump() for r in result.raw_responses],
-            "new_items": [item.model_dump() for item in result.new_items],
+        run_id = token_hex(16)
+        traces[run_id] = dump_trace({
+            "events": trace_items,
             "timestamp": datetime.now().isoformat()
-        }
+        })
         
         logger.info(f"Streaming agent run completed: {run_id}")
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected")
     except Exception as e:
         logger.error(f"Error in WebSocket: {str(e)}")
-        await websocket.send_json({"type": "error", "data": {"message": str(e)}})
+        if sender is not None:
+            # Wait for the sender to stop so its frame and the error frame never interleave
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+        await websocket.send_bytes(orjson.dumps([{"type": "error", "data": {"message": str(e)}}]))
     finally:
+        if sender is not None and not sender.done():
+            sender.cancel()
         if websocket.client_state != WebSocketState.DISCONNECTED:
             await websocket.close()
 
@@ -389,116 +576,419 @@ async def stream_agent_run(websocket: WebSocket, agent_id: str):
 
 @app.get("/api/conversations", response_model=Dict[str, List[MessageItem]])
 async def list_conversations(_: str = Depends(get_api_key)):
-    return conversations
+    # Snapshot so serialization never iterates a mapping that is being mutated;
+    # messages are stored as validated MessageItems, so skip response model validation
+    return ORJSONResponse(content={
+        conversation_id: [message.model_dump() for message in messages]
+        for conversation_id, messages in conversations.items()
+    })
 
 @app.get("/api/conversations/{conversation_id}", response_model=List[MessageItem])
 async def get_conversation(conversation_id: str, _: str = Depends(get_api_key)):
-    if conversation_id not in conversations:
-        raise HTTPException(status_code=404, detail="Conversation not found")
-    return [MessageItem(**msg) for msg in conversations[conversation_id]]
+    messages = _get_or_404(conversations, conversation_id, "Conversation")
+    return ORJSONResponse(content=[message.model_dump() for message in messages])
 
 @app.delete("/api/conversations/{conversation_id}")
 async def delete_conversation(conversation_id: str, _: str = Depends(get_api_key)):
-    if conversation_id not in conversations:
-        raise HTTPException(status_code=404, detail="Conversation not found")
-    del conversations[conversation_id]
+    _get_or_404(conversations, conversation_id, "Conversation")
+    conversations.pop(conversation_id, None)
     return {"message": "Conversation deleted"}
 
 # Trace Endpoints
 
 @app.get("/api/traces/{run_id}")
 async def get_trace(run_id: str, _: str = Depends(get_api_key)):
-    if run_id not in traces:
-        raise HTTPException(status_code=404, detail="Trace not found")
-    return traces[run_id]
+    return Response(content=_get_or_404(traces, run_id, "Trace"), media_type="application/json")
 
 # ------------------ Helper Functions ------------------
 
-async def get_agent_instance(agent_id: str) -> Agent:
-    """Get or create an agent instance from its configuration."""
-    if agent_id in agent_instances:
-        return agent_instances[agent_id]
-    
-    if agent_id not in agent_configs:
-        raise HTTPException(status_code=404, detail="Agent not found")
-    
-    config = agent_configs[agent_id]
-    
-    # Map the model name to Azure deployment name if needed
-    model = config["model"]
-    if model in AZURE_MODEL_MAPPING:
-        azure_model = AZURE_MODEL_MAPPING[model]
-        logger.info(f"Mapping model {model} to Azure deployment {azure_model}")
-        model = azure_model
-    
-    # Create tools
+async def fetch_azure_status(client: AsyncAzureOpenAI) -> AzureOpenAIStatus:
+    """Test the Azure OpenAI connection by listing the available deployments."""
+    try:
+        deployments = await client.deployments.list()
+        available_models = [d.id for d in deployments.data]
+        
+        return AzureOpenAIStatus(
+            status="ok",
+            models=available_models
+        )
+    except Exception as e:
+        logger.error(f"Azure OpenAI health check failed: {str(e)}")
+        return AzureOpenAIStatus(
+            status="error",
+            models=[f"Error: {str(e)}"]
+        )
+
+def _get_or_404(store: Any, key: str, label: str) -> Any:
+    """Look up ``key`` in a storage mapping, raising a 404 if it is missing or expired."""
+    try:
+        return store[key]
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+
+def _append_message(conversation_id: str, message: MessageItem) -> None:
+    """Append a message to a conversation, creating the conversation if needed."""
+    conversations.setdefault(conversation_id, deque(maxlen=MAX_HISTORY)).append(message)
+
+def _json_default(obj: Any) -> Any:
+    """orjson fallback for SDK objects that are not natively serializable."""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    return str(obj)
+
+def dump_trace(trace: Dict[str, Any]) -> bytes:
+    """Serialize a trace, including SDK dataclasses, to the JSON bytes kept in ``traces``."""
+    return orjson.dumps(trace, default=_json_default)
+
+def _compile_tool(tool_code: str, tool_name: str) -> Optional[bytes]:
+    """Compile and execute function tool code, returning the pickled function.
+
+    Runs in a tool pool worker process, which keeps compiling and executing the
+    module body off the event loop. This is not a sandbox: unpickling the result
+    in the server imports the modules the function references, and the tool
+    itself runs in the server whenever it is called. Returns None if the code
+    does not define a function called ``tool_name``.
+    """
+    code = compile(tool_code, f"<tool:{tool_name}>", "exec")
+    namespace = {}
+    exec(code, namespace)
+    tool_func = namespace.get(tool_name)
+    if tool_func is None:
+        return None
+    return cloudpickle.dumps(tool_func)
+
+def _reset_tool_pool(pool: ProcessPoolExecutor) -> None:
+    """Replace ``pool`` with a fresh tool pool and stop its worker processes."""
+    if app.state.tool_exec_pool is pool:
+        app.state.tool_exec_pool = ProcessPoolExecutor(max_workers=TOOL_POOL_WORKERS)
+    # shutdown() does not stop a worker stuck in user code, so terminate workers explicitly
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+async def compile_tool(tool_code: str, tool_name: str) -> Optional[bytes]:
+    """Run ``_compile_tool`` in the tool pool with a timeout.
+
+    A pool whose worker hung or died is replaced so later agent saves can
+    still compile function tools.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = app.state.tool_exec_pool
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(pool, _compile_tool, tool_code, tool_name),
+                TOOL_COMPILE_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            _reset_tool_pool(pool)
+            raise TimeoutError(f"Compiling {tool_name} took longer than {TOOL_COMPILE_TIMEOUT}s")
+        except BrokenProcessPool:
+            # The worker may have been killed by another tool, so retry once on a new pool
+            _reset_tool_pool(pool)
+            if attempt:
+                raise
+
+async def build_tools(config: AgentConfig) -> List[Any]:
+    """Compile an agent's tool configuration into SDK tool objects.
+
+    Called when a configuration is created or updated so that function tool
+    code is compiled once rather than every time an agent instance is built.
+    """
     tools = []
-    for tool_config in config["tools"]:
-        if tool_config["type"] == "function" and tool_config.get("function_code"):
+    for tool_config in config.tools:
+        if tool_config.type == "function" and tool_config.function_code:
             # Create function tool from code string
             # This is simplified and would need proper security measures in production
             try:
-                tool_code = tool_config["function_code"]
-                tool_name = tool_config["name"]
-                
-                # Create a namespace to execute the function code
-                namespace = {}
-                exec(tool_code, namespace)
+                tool_code = tool_config.function_code
+                tool_name = tool_config.name
                 
-                # Get the function from the namespace
-                tool_func = namespace.get(tool_name)
-                if not tool_func:
+                # Compile and execute the function code in a worker process
+                payload = await compile_tool(tool_code, tool_name)
+                if payload is None:
                     logger.warning(f"Function {tool_name} not found in code")
                     continue
                 
                 # Create function tool
-                tools.append(function_tool(tool_func))
+                tools.append(function_tool(cloudpickle.loads(payload)))
             except Exception as e:
                 logger.error(f"Error creating function tool: {str(e)}")
                 continue
-        elif tool_config["type"] == "web_search":
+        elif tool_config.type == "web_search":
             # Add web search tool
-            from agents import WebSearchTool
             tools.append(WebSearchTool())
-        elif tool_config["type"] == "file_search":
+        elif tool_config.type == "file_search":
             # Add file search tool if parameters are provided
-            if tool_config.get("parameters"):
-                from agents import FileSearchTool
-                tools.append(FileSearchTool(**tool_config["parameters"]))
+            if tool_config.parameters:
+                try:
+                    tools.append(FileSearchTool(**tool_config.parameters))
+                except (TypeError, ValueError) as e:
+                    raise HTTPException(
+                        status_code=422,
+                        detail=f"Invalid parameters for file search tool {tool_config.name}: {str(e)}",
+                    )
+    return tools
+
+@singledispatch
+def serialize_stream_event(event: Any) -> Tuple[str, Any]:
+    """Convert an SDK stream event into the ``(type, data)`` pair sent to clients.
+
+    Dispatches on the event class; this fallback covers event types without a
+    registered handler.
+    """
+    event_type = getattr(event, "type", None)
+    if not isinstance(event_type, str):
+        event_type = type(event).__name__
+    logger.warning(f"No serializer registered for event of type {event_type}. Raw event: {str(event)}")
+    return event_type, {"message": f"Unstructured event: {event_type}", "content": str(event)}
+
+@serialize_stream_event.register
+def _(event: RawResponsesStreamEvent) -> Tuple[str, Any]:
+    return event.type, event.data
+
+@serialize_stream_event.register
+def _(event: RunItemStreamEvent) -> Tuple[str, Any]:
+    return event.type, {"name": event.name, "item": _run_item_payload(event.item)}
+
+def _run_item_payload(item: Any) -> Dict[str, Any]:
+    """Shape a run item the way the playground's execution steps read it.
+
+    Tool calls carry the tool ``name`` and parsed ``args``; tool outputs carry ``output``.
+    """
+    payload = {"type": item.type, "raw_item": item.raw_item}
+    if item.type == "tool_call_item":
+        # Hosted tool calls (e.g. web search) have no name or arguments
+        payload["name"] = getattr(item.raw_item, "name", None)
+        arguments = getattr(item.raw_item, "arguments", None)
+        try:
+            payload["args"] = orjson.loads(arguments) if arguments else None
+        except orjson.JSONDecodeError:
+            payload["args"] = arguments
+    elif item.type == "tool_call_output_item":
+        payload["output"] = item.output
+    return payload
+
+@serialize_stream_event.register
+def _(event: AgentUpdatedStreamEvent) -> Tuple[str, Any]:
+    return event.type, {"new_agent": {"name": event.new_agent.name}}
+
+async def drain_stream_events(websocket: WebSocket, queue: asyncio.Queue) -> None:
+    """Send queued stream events to the client until the end-of-stream marker.
+
+    Events that arrive within ``STREAM_BATCH_INTERVAL`` of each other are sent
+    together as a single JSON array frame.
+    """
+    try:
+        while True:
+            batch = [await queue.get()]
+            await asyncio.sleep(STREAM_BATCH_INTERVAL)
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            finished = batch[-1] is _STREAM_END
+            if finished:
+                batch.pop()
+            if batch:
+                await websocket.send_bytes(orjson.dumps(batch, default=_json_default))
+            if finished:
+                return
+    except BaseException:
+        # Free up space so a producer blocked on a full queue wakes and sees we stopped
+        while not queue.empty():
+            queue.get_nowait()
+        raise
+
+async def run_with_backoff(agent: Agent, input_text: str, max_retries: int = BULK_MAX_RETRIES):
+    """Run an agent, retrying with jittered exponential backoff when rate limited."""
+    delay = 1.0
+    for attempt in range(max_retries):
+        try:
+            return await Runner.run(agent, input_text)
+        except RateLimitError:
+            if attempt == max_retries - 1:
+                raise
+            logger.warning(f"Rate limited, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay + random.uniform(0, delay))
+            delay *= 2
+
+def resolve_model(model: str) -> str:
+    """Map the model name to Azure deployment name if needed."""
+    if model in AZURE_MODEL_MAPPING:
+        azure_model = AZURE_MODEL_MAPPING[model]
+        logger.info(f"Mapping model {model} to Azure deployment {azure_model}")
+        return azure_model
+    return model
+
+async def collect_batch_output(client: AsyncAzureOpenAI, batch: Any) -> None:
+    """Record the results of a completed Azure batch on every run it contains.
+
+    Every run in the batch is terminal afterwards, so the output is applied once.
+    """
+    if batch.output_file_id:
+        content = await client.files.content(batch.output_file_id)
+        for line in content.content.splitlines():
+            if line.strip():
+                _apply_batch_result(line)
     
-    # Create agent
-    agent = Agent(
-        name=config["name"],
-        instructions=config["instructions"],
-        model=model,
-        tools=tools
+    # Requests Azure rejected are only listed in the error file; no output will arrive for them
+    _finish_batch_runs(batch.id, "failed")
+
+def _finish_batch_runs(batch_id: str, status: str) -> None:
+    """Give every run of ``batch_id`` that is not yet terminal the final ``status``."""
+    for batch_run in list(batch_runs.values()):
+        if batch_run["batch_id"] == batch_id and batch_run["status"] not in BATCH_TERMINAL_STATUSES:
+            batch_run["status"] = status
+
+async def delete_batch_files(client: AsyncAzureOpenAI, *file_ids: Optional[str]) -> None:
+    """Delete batch input/output files so they do not count against the resource's file quota."""
+    for file_id in file_ids:
+        if not file_id:
+            continue
+        try:
+            await client.files.delete(file_id)
+        except Exception as e:
+            logger.warning(f"Failed to delete batch file {file_id}: {str(e)}")
+
+def _apply_batch_result(line: bytes) -> None:
+    """Record one line of a batch output file on its run, unless that run is already final.
+
+    A malformed line only fails its own run; runs that cannot be identified are
+    left for ``collect_batch_output`` to mark as failed.
+    """
+    try:
+        record = orjson.loads(line)
+        run_id = record["custom_id"]
+    except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+        logger.error(f"Unreadable batch output line: {str(e)}")
+        return
+    batch_run = batch_runs.get(run_id)
+    if batch_run is None or batch_run["status"] in BATCH_TERMINAL_STATUSES:
+        return
+    # The output line is the run's trace
+    traces[run_id] = line
+    try:
+        response = record.get("response") or {}
+        if response.get("status_code") != 200:
+            raise ValueError(f"status code {response.get('status_code')}")
+        # content is null when, for example, the completion was content filtered
+        message = MessageItem(role="assistant", content=response["body"]["choices"][0]["message"]["content"])
+    except Exception as e:
+        logger.error(f"Batch run {run_id} failed: {str(e)}")
+        batch_run["status"] = "failed"
+        return
+    batch_run["final_output"] = message.content
+    batch_run["status"] = "completed"
+    _append_message(batch_run["conversation_id"], message)
+
+def _build_agent(config: AgentConfig) -> Agent:
+    """Create an agent instance from its configuration and compiled tools."""
+    return Agent(
+        name=config.name,
+        instructions=config.instructions,
+        model=resolve_model(config.model),
+        # Tools are compiled when the configuration is created or updated
+        tools=compiled_tools[config.id]
     )
-    
-    # Cache agent instance
-    agent_instances[agent_id] = agent
-    
-    return agent
-
-# ------------------ Server Startup ------------------
 
-@app.on_event("startup")
-async def startup_event():
-    # Disable tracing to prevent errors when using Azure OpenAI
-    set_tracing_disabled(disabled=True)
-    logger.info("OpenAI Agents SDK tracing disabled.")
+async def get_agent_instance(agent_id: str) -> Agent:
+    """Get the cached agent instance, rebuilding it if it was evicted."""
+    agent = agent_instances.get(agent_id)
+    if agent is None:
+        agent = agent_instances[agent_id] = _build_agent(_get_or_404(agent_configs, agent_id, "Agent"))
+    return agent
 
-    # Configure Azure OpenAI
-    success = await setup_azure_openai()
-    if not success:
-        logger.warning("Failed to configure Azure OpenAI client on startup")
-    
-    # Enable verbose logging if specified
-    if os.getenv("ENABLE_VERBOSE_LOGGING", "false").lower() == "true":
-        agents.enable_verbose_stdout_logging()
-        logger.info("Verbose logging enabled")
+# ------------------ Batch Submission ------------------
+
+class BatchQueue:
+    """Collects batch-mode runs and submits them to the Azure Batch API.
+
+    Queued requests are written to a JSONL file and submitted as one
+    ``/chat/completions`` batch job once ``max_pending`` requests are waiting
+    or ``flush_interval`` seconds have passed since the first one arrived.
+    Batch requests are single chat completions, so agent tools are not run.
+    """
+
+    def __init__(self, client: AsyncAzureOpenAI, max_pending: int = BATCH_MAX_PENDING, flush_interval: float = BATCH_FLUSH_INTERVAL):
+        self.client = client
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def submit(self, run_id: str, body: Dict[str, Any]) -> None:
+        """Queue a chat completion request body for the run ``run_id``."""
+        self._queue.put_nowait((run_id, body))
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(pending) < self.max_pending:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                batch_id = await self._submit(pending)
+                status = "submitted"
+                logger.info(f"Submitted batch {batch_id} with {len(pending)} runs")
+            except Exception as e:
+                batch_id = None
+                status = "failed"
+                logger.error(f"Error submitting batch: {str(e)}")
+            
+            for run_id, _ in pending:
+                batch_run = batch_runs.get(run_id)
+                if batch_run is not None:
+                    batch_run["batch_id"] = batch_id
+                    batch_run["status"] = status
+
+    async def _submit(self, pending: List[Tuple[str, Dict[str, Any]]]) -> str:
+        jsonl = b"\n".join(
+            orjson.dumps({"custom_id": run_id, "method": "POST", "url": "/chat/completions", "body": body})
+            for run_id, body in pending
+        )
+        batch_file = await self.client.files.create(file=("batch.jsonl", jsonl), purpose="batch")
+        try:
+            batch = await self.client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/chat/completions",
+                completion_window="24h",
+            )
+        except Exception:
+            # The input file would otherwise never be cleaned up
+            await delete_batch_files(self.client, batch_file.id)
+            raise
+        return batch.id
 
 # ------------------ Run Server ------------------
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    
+    # Multiple workers need an import string; note each worker has its own in-memory storage
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "main:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",  # uvloop does not support Windows
+        http="httptools",
+        ws="websockets",
+        ws_per_message_deflate=True,
+        workers=workers,
+    )
\ No newline at end of file
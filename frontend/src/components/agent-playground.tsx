@@ -104,36 +104,42 @@ export default function AgentPlayground({ agentId }: AgentPlaygroundProps) {
       const steps: ExecutionStepItem[] = [];
       
       socket.onmessage = (event) => {
-        const data = JSON.parse(event.data as string); // Added type assertion for event.data
+        // The server sends batches of events as JSON arrays in binary frames
+        const text = typeof event.data === 'string'
+          ? event.data
+          : new TextDecoder().decode(event.data as ArrayBuffer);
+        const batch = JSON.parse(text);
         
-        // Handle different event types
-        if (data.type === 'raw_response_event') {
-          if (data.data && data.data.delta) {
-            setStreamedResponse((prev) => prev + (data.data.delta || ''));
-          }
-        } else if (data.type === 'run_item_stream_event') {
-          // Track tool calls and outputs for execution steps
-          if (data.data && data.data.item) {
-            const item = data.data.item as ExecutionStepItem; // Added type assertion
-            if (item.type === 'tool_call_item' || item.type === 'tool_call_output_item') {
-              steps.push(item);
-              setExecutionSteps([...steps]);
+        for (const data of (Array.isArray(batch) ? batch : [batch])) {
+          // Handle different event types
+          if (data.type === 'raw_response_event') {
+            if (data.data && data.data.delta) {
+              setStreamedResponse((prev) => prev + (data.data.delta || ''));
+            }
+          } else if (data.type === 'run_item_stream_event') {
+            // Track tool calls and outputs for execution steps
+            if (data.data && data.data.item) {
+              const item = data.data.item as ExecutionStepItem; // Added type assertion
+              if (item.type === 'tool_call_item' || item.type === 'tool_call_output_item') {
+                steps.push(item);
+                setExecutionSteps([...steps]);
+              }
+            }
+          } else if (data.type === 'final_output') {
+            // Set conversation ID from the response if not already set
+            if (!conversationId && data.data.conversation_id) {
+              setConversationId(data.data.conversation_id as string); // Added type assertion
             }
-          }
-        } else if (data.type === 'final_output') {
-          // Set conversation ID from the response if not already set
-          if (!conversationId && data.data.conversation_id) {
-            setConversationId(data.data.conversation_id as string); // Added type assertion
-          }
           
-          // Add assistant message with final response
-          setMessages((prevMessages) => [
-            ...prevMessages,
-            { role: 'assistant', content: data.data.content as string } // Added type assertion
-          ]);
+            // Add assistant message with final response
+            setMessages((prevMessages) => [
+              ...prevMessages,
+              { role: 'assistant', content: data.data.content as string } // Added type assertion
+            ]);
           
-          setIsStreaming(false);
-          setStreamedResponse('');
+            setIsStreaming(false);
+            setStreamedResponse('');
+          }
         }
       };
       
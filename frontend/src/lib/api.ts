@@ -127,7 +127,8 @@ export async function deleteConversation(id: string): Promise<{ message: string
 export async function runAgent(
   agentId: string,
   input: string,
-  conversationId?: string
+  conversationId?: string,
+  batch = false
 ): Promise<RunResponse> {
   return fetchAPI<RunResponse>('api/run', {
     method: 'POST',
@@ -135,14 +136,21 @@ export async function runAgent(
       agent_id: agentId,
       input,
       conversation_id: conversationId,
+      batch,
     },
   });
 }
 
+// Poll a run submitted with batch=true
+export async function getBatchRun(runId: string): Promise<RunResponse> {
+  return fetchAPI<RunResponse>(`api/run/${runId}`);
+}
+
 // WebSocket streaming
 export function createAgentStream(agentId: string, input: string, conversationId?: string) {
   const wsUrl = `${API_BASE_URL.replace('http', 'ws')}/api/stream/${agentId}`;
   const socket = new WebSocket(wsUrl);
+  socket.binaryType = 'arraybuffer';
   
   socket.onopen = () => {
     socket.send(JSON.stringify({
@@ -158,6 +166,7 @@ export function createAgentStream(agentId: string, input: string, conversationId
 export interface TraceData {
   raw_responses?: unknown[];
   new_items?: unknown[];
+  events?: unknown[];
   timestamp?: string;
 }
 